@@ -1,214 +1,667 @@
-import subprocess
-import argparse
-import os
-import logging
-
-# Configure logging for better verbosity and debugging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-def run_command(cmd, log_prefix):
-    """
-    Executes a shell command and logs its output with detailed error handling.
-
-    Args:
-        cmd (list): Command to execute as a list of strings.
-        log_prefix (str): Prefix for log messages to identify the command source.
-
-    Returns:
-        int: Return code of the command (0 for success, non-zero for failure).
-    """
-    cmd_str = ' '.join(cmd)
-    logging.info(f"{log_prefix}: Running command: {cmd_str}")
-
-    try:
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                   universal_newlines=True)
-        stdout, stderr = process.communicate()
-
-        if stdout:
-            logging.info(f"{log_prefix}: Standard Output:\n{stdout}")
-        if stderr:
-            logging.error(f"{log_prefix}: Standard Error:\n{stderr}")
-
-        return process.returncode
-
-    except FileNotFoundError as e:
-        logging.error(f"{log_prefix}: Command not found: {e}. Ensure it is in your PATH.")
-        return 1  # Command not found is a failure
-
-    except Exception as e:
-        logging.error(f"{log_prefix}: Error executing command: {e}")
-        return 1  # Generic error
-
-
-def unmap_reads(input_file, output_file, reference_genome, log_prefix):
-    """
-    Maps reads to a reference genome using Minimap2, filters unmapped reads using Samtools,
-    and sorts the output.
-
-    Args:
-        input_file (str): Path to the input FASTQ/BAM file.
-        output_file (str): Path to the output BAM file containing unmapped reads.
-        reference_genome (str): Path to the reference genome FASTA file.
-        log_prefix (str): Prefix for log messages.
-
-    Returns:
-        bool: True if the process succeeds, False otherwise.
-    """
-
-    logging.info(f"{log_prefix}: Starting unmapping process...")
-
-    # Construct commands
-    minimap2_command = [
-        "minimap2",
-        "-ax", "sr",
-        "-t", str(os.cpu_count()),
-        reference_genome,
-        input_file
-    ]
-
-    samtools_view_command = [
-        "samtools",
-        "view",
-        "-b",
-        "-f", "4",  # Changed from 12 to 4 to filter for unmapped reads
-        "-"
-    ]
-
-    samtools_sort_command = [
-        "samtools",
-        "sort",
-        "-o", output_file
-    ]
-
-    # Execute pipeline
-    try:
-        minimap2_process = subprocess.Popen(minimap2_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        samtools_view_process = subprocess.Popen(samtools_view_command, stdin=minimap2_process.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        samtools_sort_process = subprocess.Popen(samtools_sort_command, stdin=samtools_view_process.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-
-        # Close standard input for subprocesses to avoid deadlocks
-        minimap2_process.stdout.close()
-        samtools_view_process.stdout.close()
-
-        # Capture output/error logs
-        stdout, stderr = samtools_sort_process.communicate()
-
-        if stdout:
-            logging.info(f"{log_prefix}: Standard Output:\n{stdout}")
-        if stderr:
-            logging.error(f"{log_prefix}: Standard Error:\n{stderr}")
-
-        # Check return codes
-        if minimap2_process.returncode != 0 or samtools_view_process.returncode != 0 or samtools_sort_process.returncode != 0:
-            logging.error(f"{log_prefix}: One or more processes failed.")
-            return False
-
-        logging.info(f"{log_prefix}: Unmapping process completed successfully.")
-        return True
-
-    except Exception as e:
-        logging.error(f"{log_prefix}: An error occurred during the unmapping process: {e}")
-        return False
-
-
-def convert_bam_to_fastq(input_bam, output_fastq, log_prefix):
-    """
-    Converts a BAM file to FASTQ format using samtools.
-
-    Args:
-        input_bam (str): Path to the input BAM file.
-        output_fastq (str): Path to the output FASTQ file.
-        log_prefix (str): Prefix for log messages.
-
-    Returns:
-        bool: True if the conversion succeeds, False otherwise.
-    """
-
-    logging.info(f"{log_prefix}: Converting BAM to FASTQ format...")
-
-    bam_to_fastq_command = [
-        "samtools",
-        "fastq",
-        "-o", output_fastq,
-        input_bam
-    ]
-
-    return_code = run_command(bam_to_fastq_command, log_prefix)
-    if return_code == 0:
-        logging.info(f"{log_prefix}: Conversion to FASTQ completed successfully. Output saved to {output_fastq}.")
-        return True
-    else:
-        logging.error(f"{log_prefix}: Error: Failed to convert BAM to FASTQ.")
-        return False
-
-
-def cleanup_intermediate_files(files_to_remove):
-    """
-    Removes intermediate files.
-
-    Args:
-        files_to_remove (list): List of file paths to remove.
-    """
-
-    logging.info("Cleaning up intermediate files...")
-    for file in files_to_remove:
-        if os.path.exists(file):
-            os.remove(file)
-            logging.info(f"Removed {file}")
-        else:
-            logging.warning(f"File {file} not found, skipping removal.")
-
-
-def main():
-    """
-    Main function to handle arguments and process the unmapped reads step-by-step.
-    """
-
-    # Parsing command-line arguments
-    parser = argparse.ArgumentParser(description="Unmap reads from raw FASTQ file using Minimap2 and Samtools.")
-    parser.add_argument("--input", required=True, help="Path to the input FASTQ file containing raw reads.")
-    parser.add_argument("--output", required=True, help="Path to the output FASTQ file after unmapping.")
-    parser.add_argument("--mito", required=True, help="Path to the mitochondrial reference genome FASTA file.")
-    parser.add_argument("--chloro", required=True, help="Path to the chloroplast reference genome FASTA file.")
-    parser.add_argument("--viral_adna", required=True, help="Path to the viral ADNA reference genome FASTA file.")
-    parser.add_argument("--viral_bsat", required=True, help="Path to the viral beta-sat reference genome FASTA file.")
-
-    args = parser.parse_args()
-
-    # Define intermediate file names
-    mito_unmapped_bam = "mito_unmapped.bam"
-    chloro_unmapped_bam = "chloro_unmapped.bam"
-    viral_adna_unmapped_bam = "viral_adna_unmapped.bam"
-    final_unmapped_bam = "final_unmapped.bam"
-
-    # Unmap reads step-by-step through different reference genomes
-    if not unmap_reads(args.input, mito_unmapped_bam, args.mito, "Mito_Unmapping"):
-        logging.error("Mitochondrial unmapping failed. Exiting.")
-        return
-
-    if not unmap_reads(mito_unmapped_bam, chloro_unmapped_bam, args.chloro, "Chloro_Unmapping"):
-        logging.error("Chloroplast unmapping failed. Exiting.")
-        return
-
-    if not unmap_reads(chloro_unmapped_bam, viral_adna_unmapped_bam, args.viral_adna, "Viral_ADNA_Unmapping"):
-        logging.error("Viral ADNA unmapping failed. Exiting.")
-        return
-
-    if not unmap_reads(viral_adna_unmapped_bam, final_unmapped_bam, args.viral_bsat, "Viral_BetaSat_Unmapping"):
-        logging.error("Viral BetaSat unmapping failed. Exiting.")
-        return
-
-    # Convert final BAM file to FASTQ format
-    if not convert_bam_to_fastq(final_unmapped_bam, args.output, "BAM_to_FASTQ"):
-        logging.error("Conversion to FASTQ failed. Exiting.")
-        return
-
-    # Clean up intermediate BAM files
-    cleanup_intermediate_files([mito_unmapped_bam, chloro_unmapped_bam, viral_adna_unmapped_bam, final_unmapped_bam])
-
-    logging.info("Pipeline completed successfully.")
-
-
-if __name__ == "__main__":
-    main()
+import subprocess
+import argparse
+import concurrent.futures
+import gzip
+import mmap
+import os
+import shlex
+import shutil
+import tempfile
+import threading
+import logging
+
+try:
+    import fcntl
+except ImportError:  # non-Linux platforms
+    fcntl = None
+
+# Configure logging for better verbosity and debugging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# minimap2 speedup regresses past ~32 threads due to synchronization overhead
+MAX_MINIMAP2_THREADS = 32
+
+# samtools (de)compression threads; the SAM-in/FASTQ-out stages rarely benefit
+# from more than a couple of extra threads
+SAMTOOLS_THREADS = 2
+
+# Kernel pipe buffer size for high-throughput data pipes held by Python
+PIPE_BUFFER_BYTES = 1 << 20
+
+# Concatenation of all reference FASTAs, indexed once and shared by all samples
+COMBINED_REFERENCE = "combined.fa"
+
+# The reusable index built from the combined reference; kept in the working
+# directory while the FASTA itself is scratch
+COMBINED_INDEX = "combined.mmi"
+
+
+def widen_pipe(stream, log_prefix):
+    """
+    Enlarges the kernel buffer of a pipe to PIPE_BUFFER_BYTES where supported.
+
+    Bigger pipe-fulls mean fewer context switches per unit of data when a
+    subprocess streams SAM records into Python. Best-effort: the default
+    64 KiB buffer is kept where F_SETPIPE_SZ is unavailable or denied.
+
+    Args:
+        stream (file): Pipe end of a running subprocess.
+        log_prefix (str): Prefix for log messages.
+    """
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(stream.fileno(), fcntl.F_SETPIPE_SZ, PIPE_BUFFER_BYTES)
+    except OSError as e:
+        logging.warning("%s: Could not widen pipe buffer: %s", log_prefix, e)
+
+
+def available_cpus():
+    """
+    Returns the number of CPUs available to this process.
+
+    Uses the scheduler affinity mask where supported, so cgroup, taskset and
+    batch-scheduler allocations are respected instead of the raw machine core
+    count, which over-subscribes CPUs on shared nodes.
+
+    Returns:
+        int: Number of usable CPUs (at least 1).
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Resolved once at import: the affinity lookup reads /proc on Linux, and the
+# batch/parallel paths would otherwise repeat it for every sample
+AVAILABLE_CPUS = available_cpus()
+
+def log_stream(stream, log_prefix):
+    """
+    Forwards each line of a subprocess stream to the log as it arrives.
+
+    Streaming keeps memory flat (no whole-output buffering as with
+    communicate()) and surfaces tool progress and hangs in real time.
+
+    Args:
+        stream (file): Text-mode stream of a running subprocess.
+        log_prefix (str): Prefix for log messages.
+    """
+    for line in stream:
+        line = line.rstrip()
+        if line:
+            logging.info("%s: %s", log_prefix, line)
+
+
+def run_command(cmd, log_prefix):
+    """
+    Executes a shell command, streaming its stderr to the log line by line.
+
+    The tools used here write their results to files (or stdout pipes handled
+    elsewhere), so stdout is discarded rather than buffered.
+
+    Args:
+        cmd (list): Command to execute as a list of strings.
+        log_prefix (str): Prefix for log messages to identify the command source.
+
+    Returns:
+        int: Return code of the command (0 for success, non-zero for failure).
+    """
+    cmd_str = ' '.join(cmd)
+    logging.info("%s: Running command: %s", log_prefix, cmd_str)
+
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                   encoding="utf-8", errors="replace", bufsize=1)
+        log_stream(process.stderr, log_prefix)
+        return process.wait()
+
+    except FileNotFoundError as e:
+        logging.error("%s: Command not found: %s. Ensure it is in your PATH.", log_prefix, e)
+        return 1  # Command not found is a failure
+
+    except Exception as e:
+        logging.error("%s: Error executing command: %s", log_prefix, e)
+        return 1  # Generic error
+
+
+def run_pipeline(pipeline, log_prefix):
+    """
+    Executes a shell pipeline in a single child process and logs its output.
+
+    Forking /bin/bash once and letting it wire the pipe chain replaces one
+    Python fork()+exec() per stage; `set -o pipefail` keeps per-stage failure
+    detection intact.
+
+    Args:
+        pipeline (str): Shell pipeline to execute (arguments pre-quoted).
+        log_prefix (str): Prefix for log messages to identify the command source.
+
+    Returns:
+        int: Return code of the pipeline (0 for success, non-zero for failure).
+    """
+
+    logging.info("%s: Running pipeline: %s", log_prefix, pipeline)
+
+    try:
+        process = subprocess.Popen(["/bin/bash", "-c", "set -o pipefail; " + pipeline],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                   encoding="utf-8", errors="replace", bufsize=1)
+        log_stream(process.stderr, log_prefix)
+        return process.wait()
+
+    except FileNotFoundError as e:
+        logging.error("%s: Command not found: %s. Ensure it is in your PATH.", log_prefix, e)
+        return 1
+
+    except Exception as e:
+        logging.error("%s: Error executing pipeline: %s", log_prefix, e)
+        return 1
+
+
+def build_index(reference, log_prefix, index=None):
+    """
+    Builds a Minimap2 short-read index (.mmi) for a reference, reusing an
+    existing index when it is newer than the reference FASTA.
+
+    Indexing is paid once per reference instead of once per minimap2
+    invocation, which matters when the pipeline is re-run across many samples.
+
+    Args:
+        reference (str): Path to the reference FASTA file.
+        log_prefix (str): Prefix for log messages.
+        index (str): Where to place the .mmi; defaults to next to the FASTA.
+
+    Returns:
+        str: Path to the .mmi index, or None if index construction failed.
+    """
+
+    if index is None:
+        index = reference + ".mmi"
+
+    if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(reference):
+        logging.info("%s: Reusing existing index %s", log_prefix, index)
+        return index
+
+    index_command = [
+        "minimap2",
+        "-x", "sr",
+        "-d", index,
+        reference
+    ]
+
+    if run_command(index_command, log_prefix) != 0:
+        logging.error("%s: Failed to build index for %s.", log_prefix, reference)
+        return None
+
+    return index
+
+
+def build_indices(references, log_prefix):
+    """
+    Ensures a .mmi index exists for every reference before mapping begins.
+
+    Building up front keeps the mapping passes free of indexing work, so the
+    index cost is paid once no matter how many samples are processed.
+
+    Args:
+        references (list): Paths to the reference genome FASTA files.
+        log_prefix (str): Prefix for log messages.
+
+    Returns:
+        bool: True if every index is available, False otherwise.
+    """
+
+    for reference in references:
+        if build_index(reference, log_prefix) is None:
+            return False
+    return True
+
+
+def prewarm_file(path, log_prefix):
+    """
+    Pulls a file into the OS page cache via mmap/madvise.
+
+    Warming the cache in the parent before the concurrent minimap2 workers
+    start means they all read one shared cached copy instead of issuing
+    competing cold reads; the kernel page cache is the shared backing store.
+    Best-effort only: failure just means a cold first read.
+
+    Args:
+        path (str): Path to the file to prewarm.
+        log_prefix (str): Prefix for log messages.
+    """
+
+    try:
+        with open(path, "rb") as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+                    mapped.madvise(mmap.MADV_WILLNEED)
+                else:
+                    mapped.read()
+            finally:
+                mapped.close()
+    except (OSError, ValueError) as e:
+        logging.warning("%s: Could not prewarm %s: %s", log_prefix, path, e)
+
+
+def build_combined_index(references, log_prefix, keep_fasta=False, tmpdir=None):
+    """
+    Builds (or reuses) the single .mmi index covering every reference.
+
+    The concatenated FASTA is pure scratch (the .mmi is self-contained), so it
+    is written under tmpdir — typically a tmpfs — and never touches slow
+    storage; only the reusable index lands in the working directory.
+
+    Args:
+        references (list): Paths to the reference genome FASTA files.
+        log_prefix (str): Prefix for log messages.
+        keep_fasta (bool): Keep the concatenated FASTA in the working
+            directory (needed when CRAM encoding will refer to it).
+        tmpdir (str): Directory for the scratch FASTA; defaults to the
+            working directory.
+
+    Returns:
+        str: Path to the combined .mmi index, or None on failure.
+    """
+
+    index = COMBINED_INDEX
+
+    if keep_fasta or not tmpdir:
+        combined_fasta = COMBINED_REFERENCE
+    else:
+        combined_fasta = os.path.join(tmpdir, COMBINED_REFERENCE)
+
+    def fresh(path):
+        return (os.path.exists(path)
+                and all(os.path.getmtime(path) >= os.path.getmtime(ref) for ref in references))
+
+    # Reuse the combined index if it is newer than every reference; CRAM
+    # encoding additionally needs the combined FASTA on disk, and it must be
+    # just as fresh — a stale copy would not match alignments made against
+    # the current index
+    if fresh(index) and (not keep_fasta or fresh(COMBINED_REFERENCE)):
+        logging.info("%s: Reusing existing index %s", log_prefix, index)
+        return index
+
+    # Concatenate all references into a single FASTA and index it
+    try:
+        with open(combined_fasta, "wb") as combined:
+            for reference in references:
+                with open(reference, "rb") as ref:
+                    shutil.copyfileobj(ref, combined)
+    except OSError as e:
+        logging.error("%s: Failed to build combined reference: %s", log_prefix, e)
+        return None
+
+    return build_index(combined_fasta, log_prefix, index=index)
+
+
+def unmap_reads_combined(input_fastq, output_fastq, references, log_prefix, keep_alignments=None, threads=None, tmpdir=None):
+    """
+    Maps reads against all reference genomes in a single Minimap2 pass and writes
+    the unmapped reads directly as FASTQ.
+
+    The references are concatenated into one FASTA so that a read mapping to any
+    of them is filtered out in one alignment pass, avoiding the repeated
+    BAM encode/sort/decode cycles of the stage-by-stage approach.
+
+    Args:
+        input_fastq (str): Path to the input FASTQ file containing raw reads.
+        output_fastq (str): Path to the output FASTQ file of unmapped reads.
+        references (list): Paths to the reference genome FASTA files.
+        log_prefix (str): Prefix for log messages.
+        keep_alignments (str): Optional path for an on-disk CRAM of all
+            alignments, kept for resumability/inspection. CRAM with the fast
+            compression preset is used instead of BAM since it is smaller and
+            cheaper to re-scan.
+        threads (int): minimap2 thread budget; defaults to all available CPUs
+            (capped). Batch mode passes a per-sample share.
+        tmpdir (str): Directory for scratch files, ideally a tmpfs.
+
+    Returns:
+        bool: True if the process succeeds, False otherwise.
+    """
+
+    logging.info("%s: Starting combined unmapping process...", log_prefix)
+
+    if threads is None:
+        threads = min(AVAILABLE_CPUS, MAX_MINIMAP2_THREADS)
+
+    combined_reference = COMBINED_REFERENCE
+    index = build_combined_index(references, log_prefix, keep_fasta=bool(keep_alignments), tmpdir=tmpdir)
+    if index is None:
+        return False
+
+    minimap2_stage = (
+        f"minimap2 -ax sr -t {threads} "
+        f"{shlex.quote(index)} {shlex.quote(input_fastq)}"
+    )
+
+    # When an on-disk intermediate is requested, keep it as fast-preset CRAM
+    # and derive the unmapped FASTQ from it afterwards
+    if keep_alignments:
+        pipeline = (
+            f"{minimap2_stage}"
+            f" | samtools view -@ {SAMTOOLS_THREADS} -C -T {shlex.quote(combined_reference)}"
+            f" --output-fmt-option fast -o {shlex.quote(keep_alignments)} -"
+        )
+
+        if run_pipeline(pipeline, log_prefix) != 0:
+            logging.error("%s: One or more processes failed.", log_prefix)
+            return False
+
+        # samtools fastq reads CRAM transparently
+        samtools_fastq_command = [
+            "samtools",
+            "fastq",
+            "-@", str(SAMTOOLS_THREADS),
+            "-f", "4",
+            "--reference", combined_reference,
+            "-0", output_fastq,
+            keep_alignments
+        ]
+
+        if run_command(samtools_fastq_command, log_prefix) != 0:
+            logging.error("%s: Failed to extract unmapped reads from %s.", log_prefix, keep_alignments)
+            return False
+
+        logging.info("%s: Combined unmapping process completed successfully. Alignments kept in %s.", log_prefix, keep_alignments)
+        return True
+
+    # Emit unmapped reads straight to FASTQ; no BAM intermediate is needed
+    pipeline = (
+        f"{minimap2_stage}"
+        f" | samtools fastq -@ {SAMTOOLS_THREADS} -f 4 -0 {shlex.quote(output_fastq)} -"
+    )
+
+    if run_pipeline(pipeline, log_prefix) != 0:
+        logging.error("%s: One or more processes failed.", log_prefix)
+        return False
+
+    logging.info("%s: Combined unmapping process completed successfully.", log_prefix)
+    return True
+
+
+def unmapped_read_names(input_fastq, reference, threads, log_prefix):
+    """
+    Maps reads against a single reference and collects the names of reads
+    that did not map.
+
+    Args:
+        input_fastq (str): Path to the input FASTQ file.
+        reference (str): Path to the reference genome FASTA file.
+        threads (int): Number of minimap2 threads for this reference.
+        log_prefix (str): Prefix for log messages.
+
+    Returns:
+        set: Names of unmapped reads, or None if the process failed.
+    """
+
+    index = build_index(reference, log_prefix)
+    if index is None:
+        return None
+
+    pipeline = (
+        f"minimap2 -ax sr -t {threads} {shlex.quote(index)} {shlex.quote(input_fastq)}"
+        f" | samtools view -@ {SAMTOOLS_THREADS} -f 4 -"
+    )
+
+    try:
+        process = subprocess.Popen(["/bin/bash", "-c", "set -o pipefail; " + pipeline],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   encoding="utf-8", errors="replace", bufsize=1)
+
+        widen_pipe(process.stdout, log_prefix)
+
+        # Drain stderr on a side thread so neither pipe can stall the other
+        stderr_thread = threading.Thread(target=log_stream, args=(process.stderr, log_prefix))
+        stderr_thread.start()
+
+        names = set()
+        for line in process.stdout:
+            names.add(line.split("\t", 1)[0])
+
+        process.wait()
+        stderr_thread.join()
+
+        if process.returncode != 0:
+            logging.error("%s: One or more processes failed.", log_prefix)
+            return None
+
+        logging.info("%s: %s reads unmapped against %s.", log_prefix, len(names), reference)
+        return names
+
+    except Exception as e:
+        logging.error("%s: An error occurred while collecting unmapped reads: %s", log_prefix, e)
+        return None
+
+
+def unmap_reads_parallel(input_fastq, output_fastq, references, log_prefix, threads=None):
+    """
+    Maps the raw FASTQ against every reference concurrently and keeps the reads
+    unmapped by all of them.
+
+    Each reference is small, so the work is parallel at the reference level:
+    one minimap2 per reference runs against the same input with a share of the
+    available cores, the per-reference unmapped read-name sets are intersected,
+    and the surviving reads are extracted from the input FASTQ in one pass.
+    The workers only wait on subprocesses, so a thread pool is sufficient.
+
+    Args:
+        input_fastq (str): Path to the input FASTQ file containing raw reads.
+        output_fastq (str): Path to the output FASTQ file of unmapped reads.
+        references (list): Paths to the reference genome FASTA files.
+        log_prefix (str): Prefix for log messages.
+        threads (int): Total minimap2 thread budget, split across references;
+            defaults to all available CPUs (capped).
+
+    Returns:
+        bool: True if the process succeeds, False otherwise.
+    """
+
+    logging.info("%s: Starting parallel unmapping across %s references...", log_prefix, len(references))
+
+    if threads is None:
+        threads = min(AVAILABLE_CPUS, MAX_MINIMAP2_THREADS)
+
+    # Warm the page cache for the indices and the shared input before the
+    # workers race to read them
+    for reference in references:
+        index = reference + ".mmi"
+        if os.path.exists(index):
+            prewarm_file(index, log_prefix)
+    prewarm_file(input_fastq, log_prefix)
+
+    threads_per_reference = max(1, threads // len(references))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(references)) as executor:
+        futures = [
+            executor.submit(unmapped_read_names, input_fastq, reference,
+                            threads_per_reference, f"{log_prefix}_{os.path.basename(reference)}")
+            for reference in references
+        ]
+        name_sets = [future.result() for future in futures]
+
+    if any(names is None for names in name_sets):
+        logging.error("%s: One or more reference passes failed.", log_prefix)
+        return False
+
+    common_names = set.intersection(*name_sets)
+    logging.info("%s: %s reads unmapped against all references.", log_prefix, len(common_names))
+
+    # Extract the surviving reads from the input FASTQ in a single pass;
+    # minimap2 accepts gzipped input transparently, so this step must too
+    input_open = gzip.open if input_fastq.endswith(".gz") else open
+    output_open = gzip.open if output_fastq.endswith(".gz") else open
+    try:
+        with input_open(input_fastq, "rt") as fastq_in, output_open(output_fastq, "wt") as fastq_out:
+            while True:
+                header = fastq_in.readline()
+                if not header:
+                    break
+                record = [header, fastq_in.readline(), fastq_in.readline(), fastq_in.readline()]
+                if header[1:].split()[0] in common_names:
+                    fastq_out.writelines(record)
+    except (OSError, ValueError) as e:  # ValueError covers UnicodeDecodeError
+        logging.error("%s: Failed to extract unmapped reads: %s", log_prefix, e)
+        return False
+
+    logging.info("%s: Parallel unmapping process completed successfully.", log_prefix)
+    return True
+
+
+def process_sample(sample_input, sample_output, references, mode, threads, log_prefix, tmpdir=None):
+    """
+    Runs the full unmapping pipeline for one sample with a thread budget.
+
+    Args:
+        sample_input (str): Path to the sample's input FASTQ file.
+        sample_output (str): Path to the sample's output FASTQ file.
+        references (list): Paths to the reference genome FASTA files.
+        mode (str): Unmapping strategy, "combined" or "parallel".
+        threads (int): minimap2 thread budget for this sample.
+        log_prefix (str): Prefix for log messages.
+        tmpdir (str): Directory for scratch files, ideally a tmpfs.
+
+    Returns:
+        bool: True if the sample succeeds, False otherwise.
+    """
+
+    if mode == "parallel":
+        return unmap_reads_parallel(sample_input, sample_output, references, log_prefix, threads=threads)
+    return unmap_reads_combined(sample_input, sample_output, references, log_prefix, threads=threads, tmpdir=tmpdir)
+
+
+def main():
+    """
+    Main function to handle arguments and process the unmapped reads step-by-step.
+    """
+
+    # Parsing command-line arguments
+    parser = argparse.ArgumentParser(description="Unmap reads from raw FASTQ file using Minimap2 and Samtools.")
+    parser.add_argument("--input", help="Path to the input FASTQ file containing raw reads.")
+    parser.add_argument("--output", help="Path to the output FASTQ file after unmapping (a .gz suffix enables compression).")
+    parser.add_argument("--input-list", default=None, metavar="TSV",
+                        help="Whitespace-separated file with one 'input output' pair per line; samples run concurrently.")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="Maximum concurrent samples in --input-list mode (default: up to 4, bounded by CPUs).")
+    parser.add_argument("--mito", required=True, help="Path to the mitochondrial reference genome FASTA file.")
+    parser.add_argument("--chloro", required=True, help="Path to the chloroplast reference genome FASTA file.")
+    parser.add_argument("--viral_adna", required=True, help="Path to the viral ADNA reference genome FASTA file.")
+    parser.add_argument("--viral_bsat", required=True, help="Path to the viral beta-sat reference genome FASTA file.")
+    parser.add_argument("--mode", choices=["combined", "parallel"], default="combined",
+                        help="Unmapping strategy: one pass against a combined reference, or concurrent per-reference passes.")
+    parser.add_argument("--keep-alignments", default=None, metavar="CRAM",
+                        help="Optional path to keep the combined-pass alignments as fast-preset CRAM (combined mode only).")
+    parser.add_argument("--tmpdir", default=None,
+                        help="Directory for scratch files (default: /dev/shm when available, so intermediates stay in RAM).")
+
+    args = parser.parse_args()
+
+    if args.input_list:
+        if args.keep_alignments:
+            parser.error("--keep-alignments is not supported with --input-list")
+    elif not args.input or not args.output:
+        parser.error("--input and --output are required unless --input-list is given")
+
+    references = [args.mito, args.chloro, args.viral_adna, args.viral_bsat]
+
+    # Scratch lives on a tmpfs when possible so intermediate I/O hits RAM, not disk
+    if args.tmpdir:
+        tmpdir_base = args.tmpdir
+    elif os.path.isdir("/dev/shm"):
+        tmpdir_base = "/dev/shm"
+    else:
+        tmpdir_base = tempfile.gettempdir()
+
+    # Per-run private scratch directory: concurrent runs on the same host get
+    # unique paths, and a fixed name in a shared world-writable directory could
+    # be pre-created or symlinked by another user
+    with tempfile.TemporaryDirectory(dir=tmpdir_base, prefix="eccdna_") as scratch_dir:
+        run_pipeline_modes(args, references, scratch_dir)
+
+
+def run_pipeline_modes(args, references, scratch_dir):
+    """
+    Dispatches the parsed arguments to the batch, parallel or combined path.
+
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+        references (list): Paths to the reference genome FASTA files.
+        scratch_dir (str): Per-run private directory for scratch files.
+    """
+
+    # Batch mode: run the whole pipeline concurrently across samples, sharing
+    # the pre-built indices via the OS page cache
+    if args.input_list:
+        try:
+            with open(args.input_list) as sample_file:
+                samples = [line.split() for line in sample_file
+                           if line.strip() and not line.lstrip().startswith("#")]
+        except OSError as e:
+            logging.error("Could not read sample list %s: %s", args.input_list, e)
+            return
+
+        if not samples or any(len(sample) != 2 for sample in samples):
+            logging.error("Sample list must contain one 'input output' pair per line. Exiting.")
+            return
+
+        # Build the indices once so no worker races to create them
+        if args.mode == "parallel":
+            if not build_indices(references, "Index_Building"):
+                logging.error("Index construction failed. Exiting.")
+                return
+        elif build_combined_index(references, "Index_Building", tmpdir=scratch_dir) is None:
+            logging.error("Index construction failed. Exiting.")
+            return
+
+        jobs = args.jobs if args.jobs > 0 else min(4, len(samples))
+        jobs = min(jobs, len(samples), AVAILABLE_CPUS)
+        threads_per_sample = max(1, min(AVAILABLE_CPUS, MAX_MINIMAP2_THREADS) // jobs)
+
+        failures = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(process_sample, sample_input, sample_output, references,
+                                args.mode, threads_per_sample,
+                                f"Sample_{os.path.basename(sample_input)}",
+                                tmpdir=scratch_dir): sample_input
+                for sample_input, sample_output in samples
+            }
+            for future in concurrent.futures.as_completed(futures):
+                if not future.result():
+                    failures += 1
+                    logging.error("Unmapping failed for %s.", futures[future])
+
+        if failures:
+            logging.error("%s of %s samples failed. Exiting.", failures, len(samples))
+            return
+
+        logging.info("Pipeline completed successfully for %s samples.", len(samples))
+        return
+
+    # Unmap reads against all references in a single combined pass, or
+    # concurrently per reference with intersection of the unmapped read names
+    if args.mode == "parallel":
+        # Pre-build every per-reference index so the concurrent passes start
+        # mapping immediately and later samples reuse the same .mmi files
+        if not build_indices(references, "Index_Building"):
+            logging.error("Index construction failed. Exiting.")
+            return
+
+        if not unmap_reads_parallel(args.input, args.output, references, "Parallel_Unmapping"):
+            logging.error("Parallel unmapping failed. Exiting.")
+            return
+    else:
+        if not unmap_reads_combined(args.input, args.output, references, "Combined_Unmapping",
+                                    keep_alignments=args.keep_alignments, tmpdir=scratch_dir):
+            logging.error("Combined unmapping failed. Exiting.")
+            return
+
+    logging.info("Pipeline completed successfully.")
+
+
+if __name__ == "__main__":
+    main()